@@ -1,5 +1,10 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import requests
+import time
+import zlib
+from collections import deque
 from datetime import datetime, time as dtime, timedelta, timezone
 from fyers_apiv3 import fyersModel
 
@@ -24,54 +29,81 @@ CHECK_MARKET_HOURS = st.sidebar.toggle(
 OI_SPIKE_THRESHOLD  = 500
 MIN_BASE_OI         = 1000
 STRIKE_RANGE_POINTS = 100
+POLL_INTERVAL       = 30   # seconds — one TTL for spot + chain so a scan sees one snapshot
+MAX_ALERTS_TO_KEEP  = 50
+MIN_SCAN_INTERVAL   = 5    # seconds — debounce accidental double clicks / widget reruns
 
 # ================= TIMEZONE =================
 IST = timezone(timedelta(hours=5, minutes=30))
 
 # ================= SESSION STATE =================
+# prev OI/LTP live in NumPy-backed Series keyed by (option_type, strike)
+# so the per-scan delta is a single vectorized reindex, not dict lookups
 if "prev_oi" not in st.session_state:
-    st.session_state.prev_oi = {}
-    st.session_state.prev_ltp = {}
+    st.session_state.prev_oi = pd.Series(dtype="int64")
+    st.session_state.prev_ltp = pd.Series(dtype="float64")
     st.session_state.warmed_up = False
     st.session_state.last_run_date = None
+    # alert_keys mirrors alerts as a set → duplicate check is O(1),
+    # not a linear scan of the history on every spike; the deque
+    # bound makes trimming O(1) too
+    st.session_state.alerts = deque(maxlen=MAX_ALERTS_TO_KEEP)
+    st.session_state.alert_keys = set()
 
 # ================= SECRETS =================
 CLIENT_ID    = st.secrets["client_id"]
 ACCESS_TOKEN = st.secrets["access_token"]
 
 # ================= FYERS =================
-fyers = fyersModel.FyersModel(
-    client_id=CLIENT_ID,
-    token=ACCESS_TOKEN,
-    log_path=""
-)
+@st.cache_resource(show_spinner=False)
+def get_fyers_client():
+    client = fyersModel.FyersModel(
+        client_id=CLIENT_ID,
+        token=ACCESS_TOKEN,
+        log_path=""
+    )
+    # Force HTTP keep-alive so successive quotes/optionchain calls reuse
+    # the same TLS connection instead of re-handshaking per request
+    session = getattr(client.service, "session", None)
+    if session is None:
+        session = requests.Session()
+        client.service.session = session
+    session.mount(
+        "https://",
+        requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=1)
+    )
+    return client
 
 # ================= HELPERS =================
 def now_ist():
     return datetime.now(IST)
 
-def is_market_open():
-    t = now_ist().time()
+def is_market_open(now):
+    t = now.time()
     return dtime(9, 15) <= t <= dtime(15, 30)
 
-def reset_on_new_trading_day():
-    today = now_ist().date()
+def reset_on_new_trading_day(now):
+    today = now.date()
     if st.session_state.last_run_date != today:
-        st.session_state.prev_oi = {}
-        st.session_state.prev_ltp = {}
+        st.session_state.prev_oi = pd.Series(dtype="int64")
+        st.session_state.prev_ltp = pd.Series(dtype="float64")
         st.session_state.warmed_up = False
         st.session_state.last_run_date = today
+        st.session_state.alerts = deque(maxlen=MAX_ALERTS_TO_KEEP)
+        st.session_state.alert_keys = set()
         st.info("🔄 New trading day → baseline reset")
 
 # ================= API CALLS =================
+@st.cache_data(ttl=POLL_INTERVAL, show_spinner="Fetching spot...")
 def get_nifty_spot():
-    q = fyers.quotes({"symbols": "NSE:NIFTY50-INDEX"})
+    q = get_fyers_client().quotes({"symbols": "NSE:NIFTY50-INDEX"})
     if q.get("s") == "ok" and q.get("d"):
         return round(q["d"][0]["v"]["lp"])
     return None
 
+@st.cache_data(ttl=POLL_INTERVAL, show_spinner=False)
 def fetch_option_chain():
-    resp = fyers.optionchain({
+    resp = get_fyers_client().optionchain({
         "symbol": "NSE:NIFTY50-INDEX",
         "strikecount": 40,
         "timestamp": ""
@@ -81,48 +113,81 @@ def fetch_option_chain():
     data = resp["data"]
     return data.get("optionsChain", []), data.get("expiryData", [])
 
+if st.sidebar.button("🔄 Force Refresh Data"):
+    get_nifty_spot.clear()
+    fetch_option_chain.clear()
+    # also drop the debounce/replay state, or a scan right after the
+    # click would just replay the stale stored view
+    st.session_state.last_scan_ts = None
+    st.session_state.last_payload_hash = None
+    st.sidebar.success("Cache cleared → next scan fetches fresh data")
+
+def spot_from_chain(chain_rows):
+    # the optionchain payload carries the underlying index as a row
+    # with an empty option_type → no separate quotes call needed
+    for r in chain_rows:
+        if not r.get("option_type") and r.get("ltp"):
+            return round(r["ltp"])
+    return None
+
 def expiry_to_symbol_format(date_str):
     try:
         d = datetime.strptime(date_str, "%d-%m-%Y")
-        return d.strftime("%y") + str(d.month) + d.strftime("%d")
-    except:
+        return f"{d:%y}{d.month}{d:%d}"
+    except (TypeError, ValueError):
         return None
 
-def get_current_weekly_expiry(expiry_list):
-    today = now_ist().date()
-    candidates = []
-    for exp in expiry_list:
-        try:
-            exp_date = datetime.fromtimestamp(int(exp["expiry"])).date()
-            candidates.append(((exp_date - today).days, exp["date"]))
-        except:
-            pass
-    return sorted(candidates)[0][1] if candidates else None
+def _expiry_days(exp, today):
+    try:
+        return (datetime.fromtimestamp(int(exp["expiry"])).date() - today).days
+    except (KeyError, TypeError, ValueError):
+        return None
+
+# weekly expiry changes once a day at most → memoize per (day, expiry
+# set) in session state, which survives Streamlit's script reruns
+def get_current_weekly_expiry(expiry_list, now):
+    if not expiry_list:
+        return None
+    today = now.date()
+    key = (today, tuple(exp.get("expiry") for exp in expiry_list))
+    memo = st.session_state.get("expiry_memo")
+    if memo is not None and memo[0] == key:
+        return memo[1]
+    best = min(
+        ((d, exp.get("date")) for exp in expiry_list
+         if (d := _expiry_days(exp, today)) is not None),
+        default=None
+    )
+    result = best[1] if best else None
+    st.session_state.expiry_memo = (key, result)
+    return result
 
 # ================= TABLE STYLING =================
 def style_table(df):
-    def highlight_row(r):
-        styles = [""] * len(r)
+    def style_all(d):
+        styles = np.full(d.shape, "", dtype=object)
 
-        if r["ATM"]:
-            styles = ["background-color:#fff3cd"] * len(r)
+        atm_mask = d["ATM"].to_numpy()
+        styles[atm_mask, :] = "background-color:#fff3cd"
 
-        if abs(r["CE OI %"]) > OI_SPIKE_THRESHOLD:
-            styles[0] = "background-color:#ffebee;color:#c62828"
+        ce = d["CE OI %"].to_numpy()
+        pe = d["PE OI %"].to_numpy()
 
-        if abs(r["PE OI %"]) > OI_SPIKE_THRESHOLD:
-            styles[-1] = "background-color:#ffebee;color:#c62828"
+        spike = "background-color:#ffebee;color:#c62828"
+        styles[np.abs(ce) > OI_SPIKE_THRESHOLD, 0] = spike
+        styles[np.abs(pe) > OI_SPIKE_THRESHOLD, -1] = spike
 
-        if r["CE OI %"] > r["PE OI %"]:
-            styles[0] += ";font-weight:600;color:#2e7d32"
-        elif r["PE OI %"] > r["CE OI %"]:
-            styles[-1] += ";font-weight:600;color:#2e7d32"
+        lead = ";font-weight:600;color:#2e7d32"
+        ce_lead = ce > pe
+        pe_lead = pe > ce
+        styles[ce_lead, 0] = styles[ce_lead, 0] + lead
+        styles[pe_lead, -1] = styles[pe_lead, -1] + lead
 
-        return styles
+        return pd.DataFrame(styles, index=d.index, columns=d.columns)
 
     return (
         df.style
-        .apply(highlight_row, axis=1)
+        .apply(style_all, axis=None)
         .format({
             "CE OI %": "{:+.1f}%",
             "PE OI %": "{:+.1f}%",
@@ -131,79 +196,164 @@ def style_table(df):
         })
     )
 
+# ================= RENDER =================
+def render_view(spot, atm, expiry, df_view):
+    c1, c2 = st.columns(2)
+    c1.metric("NIFTY Spot", f"{spot:,}")
+    c2.metric("ATM Strike", atm)
+
+    st.subheader(f"📅 Weekly Expiry: {expiry}")
+    st.dataframe(
+        style_table(df_view),
+        width="stretch",
+        hide_index=True
+    )
+
+    if st.session_state.alerts:
+        st.subheader("🚨 Spike Alerts")
+        # one batched markdown element (newest first) instead of one
+        # ForwardMsg to the browser per alert
+        st.markdown("\n\n".join(msg for _, msg in reversed(st.session_state.alerts)))
+
 # ================= SCAN =================
 def scan():
-    if CHECK_MARKET_HOURS and not is_market_open():
-        st.warning("⏱ Market is closed (filter enabled)")
-        return
-
-    reset_on_new_trading_day()
+    now = now_ist()
 
-    spot = get_nifty_spot()
-    if spot is None:
-        st.error("Failed to fetch NIFTY spot")
+    if CHECK_MARKET_HOURS and not is_market_open(now):
+        st.warning("⏱ Market is closed (filter enabled)")
         return
 
-    atm = int(round(spot / 50) * 50)
+    # debounce: a scan that just ran is replayed, not recomputed
+    last_ts = st.session_state.get("last_scan_ts")
+    if last_ts is not None and time.monotonic() - last_ts < MIN_SCAN_INTERVAL:
+        if st.session_state.get("last_view") is not None:
+            render_view(*st.session_state.last_view)
+            return
+    st.session_state.last_scan_ts = time.monotonic()
 
-    c1, c2 = st.columns(2)
-    c1.metric("NIFTY Spot", f"{spot:,}")
-    c2.metric("ATM Strike", atm)
+    reset_on_new_trading_day(now)
 
     raw, expiry_info = fetch_option_chain()
     if not raw:
         st.error("Option chain unavailable")
         return
 
-    expiry = get_current_weekly_expiry(expiry_info)
-    expiry_filter = expiry_to_symbol_format(expiry) or expiry
-
-    df = pd.DataFrame(raw)
-    df = df[df["symbol"].str.contains(expiry_filter, regex=False, na=False)]
-
-    df = df[
-        (df["strike_price"] >= atm - STRIKE_RANGE_POINTS) &
-        (df["strike_price"] <= atm + STRIKE_RANGE_POINTS)
-    ]
-
-    rows = {}
-
-    for _, r in df.iterrows():
-        strike = int(r.strike_price)
-        opt = r.option_type
-        oi = int(r.oi)
-        ltp = float(r.ltp)
-        key = f"{opt}_{strike}"
+    # identical payload (cache hit or unchanged feed) → re-render the
+    # last view instead of redoing the pivot/styling pipeline
+    payload_hash = zlib.crc32(repr(raw).encode())
+    if (payload_hash == st.session_state.get("last_payload_hash")
+            and st.session_state.get("last_view") is not None):
+        render_view(*st.session_state.last_view)
+        return
 
-        prev_oi = st.session_state.prev_oi.get(key, 0)
-        oi_pct = ((oi - prev_oi) / prev_oi * 100) if prev_oi >= MIN_BASE_OI else 0
+    spot = spot_from_chain(raw) or get_nifty_spot()
+    if spot is None:
+        st.error("Failed to fetch NIFTY spot")
+        return
 
-        if strike not in rows:
-            rows[strike] = {
-                "Strike": strike,
-                "CE OI %": 0, "CE LTP": 0,
-                "PE OI %": 0, "PE LTP": 0,
-                "ATM": strike == atm
-            }
+    atm = int(round(spot / 50) * 50)
 
-        if opt == "CE":
-            rows[strike]["CE OI %"] = oi_pct
-            rows[strike]["CE LTP"] = ltp
-        else:
-            rows[strike]["PE OI %"] = oi_pct
-            rows[strike]["PE LTP"] = ltp
+    expiry = get_current_weekly_expiry(expiry_info, now)
+    expiry_filter = expiry_to_symbol_format(expiry) or expiry
 
-        st.session_state.prev_oi[key] = oi
-        st.session_state.prev_ltp[key] = ltp
+    # filter the raw dicts before building the DataFrame — of the
+    # hundreds of rows across all expiries we keep only the ATM window
+    lo, hi = atm - STRIKE_RANGE_POINTS, atm + STRIKE_RANGE_POINTS
+    # prefer an exact compare on the payload's own expiry field (one
+    # integer per row) over the substring probe into the symbol
+    target_ts = next(
+        (e.get("expiry") for e in expiry_info if e.get("date") == expiry), None
+    )
+    if target_ts is not None and "expiry" in raw[-1]:
+        rows = [
+            r for r in raw
+            if lo <= r.get("strike_price", 0) <= hi and r.get("expiry") == target_ts
+        ]
+    else:
+        token = expiry_filter or ""
+        rows = [
+            r for r in raw
+            if lo <= r.get("strike_price", 0) <= hi and token in (r.get("symbol") or "")
+        ]
+    if not rows:
+        # unmatched expiry token (e.g. monthly symbol format) → fall
+        # back to the strike filter alone
+        rows = [r for r in raw if lo <= r.get("strike_price", 0) <= hi]
+    if not rows:
+        st.error("No strikes in range")
+        return
 
-    df_view = pd.DataFrame(rows.values()).sort_values("Strike", ascending=False)
+    # pull only the five columns the scan uses, with fixed dtypes,
+    # instead of inferring every field in the payload
+    # dedup up front: the expiry-fallback path can keep several
+    # expiries per strike, and the prev-OI Series write-back needs a
+    # unique (option_type, strike) index just as much as the pivot
+    df = pd.DataFrame.from_records(
+        rows,
+        columns=["symbol", "option_type", "strike_price", "oi", "ltp"]
+    ).astype(
+        {"strike_price": "int64", "oi": "int64", "ltp": "float64"}
+    ).drop_duplicates(["strike_price", "option_type"])
+
+    idx = pd.MultiIndex.from_arrays(
+        [df["option_type"].to_numpy(), df["strike_price"].to_numpy(dtype=np.int64)],
+        names=["option_type", "strike_price"]
+    )
+    prev = st.session_state.prev_oi.reindex(idx).fillna(0).to_numpy(dtype=np.int64)
+    oi = df["oi"].to_numpy(dtype=np.int64)
+    df["oi_pct"] = np.where(
+        prev >= MIN_BASE_OI,
+        (oi - prev) / np.maximum(prev, 1) * 100,
+        0.0
+    )
 
-    st.subheader(f"📅 Weekly Expiry: {expiry}")
-    st.dataframe(
-        style_table(df_view),
-        width="stretch",
-        hide_index=True
+    # pairs are unique per (strike, type), so a pure reshape beats
+    # pivot_table's groupby machinery
+    pivot = df.pivot(
+        index="strike_price",
+        columns="option_type",
+        values=["oi_pct", "ltp"]
     )
+    pivot = pivot.reindex(
+        columns=pd.MultiIndex.from_product([["oi_pct", "ltp"], ["CE", "PE"]])
+    ).fillna(0)
+
+    # keep every column numeric/bool — formatting (₹, %, signs) happens
+    # only in the Styler at display time
+    strikes = pivot.index.to_numpy(dtype=np.int64)
+    df_view = pd.DataFrame({
+        "Strike": strikes,
+        "CE OI %": pivot[("oi_pct", "CE")].to_numpy(dtype=np.float64),
+        "CE LTP": pivot[("ltp", "CE")].to_numpy(dtype=np.float64),
+        "PE OI %": pivot[("oi_pct", "PE")].to_numpy(dtype=np.float64),
+        "PE LTP": pivot[("ltp", "PE")].to_numpy(dtype=np.float64),
+        "ATM": strikes == atm
+    }).sort_values("Strike", ascending=False)
+
+    cur_oi = pd.Series(oi, index=idx)
+    cur_ltp = pd.Series(df["ltp"].to_numpy(dtype=np.float64), index=idx)
+    st.session_state.prev_oi = cur_oi.combine_first(st.session_state.prev_oi).astype(np.int64)
+    st.session_state.prev_ltp = cur_ltp.combine_first(st.session_state.prev_ltp)
+
+    spike_mask = np.abs(df["oi_pct"].to_numpy()) > OI_SPIKE_THRESHOLD
+    if spike_mask.any():
+        spikes = df.loc[spike_mask, ["option_type", "strike_price", "oi_pct"]]
+        for opt, strike, pct in spikes.itertuples(index=False):
+            key = (opt, int(strike))
+            if key not in st.session_state.alert_keys:
+                alerts = st.session_state.alerts
+                if len(alerts) == alerts.maxlen:
+                    # deque is about to auto-evict the oldest alert —
+                    # drop its key so that strike can fire again
+                    st.session_state.alert_keys.discard(alerts[0][0])
+                st.session_state.alert_keys.add(key)
+                alerts.append(
+                    (key, f"{now:%H:%M:%S} • {opt} {int(strike)} OI {pct:+.0f}%")
+                )
+
+    st.session_state.last_payload_hash = payload_hash
+    st.session_state.last_view = (spot, atm, expiry, df_view)
+    render_view(spot, atm, expiry, df_view)
 
     if not st.session_state.warmed_up:
         st.session_state.warmed_up = True